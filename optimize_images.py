@@ -11,16 +11,30 @@ Examples:
     python optimize_images.py original_images/
     python optimize_images.py --output images original_images/
 
-If a directory is provided, all `.jpg` and `.png` images inside are
-processed. Output images are saved to images/ by default.
+If a directory is provided, all `.jpg`, `.jpeg` and `.png` images inside
+are processed (extensions are matched case-insensitively). Output images
+are saved to images/ by default.
 """
 import argparse
 import base64
+import concurrent.futures
+import hashlib
 import io
+import itertools
+import json
+import mmap
+import os
 import pathlib
 import re
 import shutil
-from PIL import Image, ImageFilter
+import threading
+from PIL import Image
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # Without libvips the variants are encoded with Pillow instead
+    pyvips = None
 
 BREAKPOINTS = {
     "sm": 576,
@@ -30,6 +44,16 @@ BREAKPOINTS = {
     "xxl": 1400,
 }
 
+# Formats generated for each breakpoint. AVIF is by far the slowest format to
+# encode and barely beats WebP at the small breakpoints, so it is skipped there.
+FORMATS_PER_BREAKPOINT = {
+    "sm": ("jpeg", "webp"),
+    "md": ("jpeg", "webp"),
+    "lg": ("jpeg", "webp", "avif"),
+    "xl": ("jpeg", "webp", "avif"),
+    "xxl": ("jpeg", "webp", "avif"),
+}
+
 DEFAULT_QUALITY = {
     "jpeg": 80,
     "webp": 90,
@@ -44,6 +68,11 @@ CUSTOM_IMAGES_QUALITY = {
     },
 }
 
+# Maximum number of variants encoded concurrently within one process
+ENCODE_THREADS = 8
+
+_encode_slots = threading.BoundedSemaphore(ENCODE_THREADS)
+
 FORMATS = {
     ".jpg": "JPEG",
     ".jpeg": "JPEG",
@@ -52,76 +81,220 @@ FORMATS = {
     ".avif": "AVIF",
 }
 
-def generate_variants(img_path: pathlib.Path, output_dir: pathlib.Path) -> str:
-    img = Image.open(img_path)
-    stem, ext = img_path.stem, img_path.suffix
-    filename = img_path.name
+# Encoder options passed along with the quality when saving variants.
+# JPEG skips the extra Huffman optimization pass and always uses 4:2:0
+# chroma subsampling, which keeps encoding on libjpeg-turbo's fast path.
+# AVIF, by far the slowest format, uses a fast encoder speed (libvips
+# effort 1 is speed 8) and a single thread per encode, leaving the cores
+# to the process and thread pools.
+PILLOW_SAVE_OPTIONS = {
+    "JPEG": {"optimize": False, "progressive": False, "subsampling": 2},
+    "PNG": {"optimize": True},
+    "WEBP": {"optimize": True},
+    "AVIF": {"speed": 8, "range": "full", "subsampling": "4:2:0", "max_threads": 1},
+}
 
-    # Ensure output directory exists
-    output_dir.mkdir(parents=True, exist_ok=True)
+VIPS_SAVE_OPTIONS = {
+    "JPEG": {"optimize_coding": False, "interlace": False, "subsample_mode": "on", "keep": "none"},
+    "PNG": {"keep": "none"},
+    "WEBP": {"keep": "none"},
+    "AVIF": {"compression": "av1", "effort": 1, "subsample_mode": "on", "keep": "none"},
+}
 
-    # Get quality settings for this specific image, or use defaults
-    quality_settings = CUSTOM_IMAGES_QUALITY.get(filename, DEFAULT_QUALITY)
+# Longest edge of the blur placeholder embedded in the HTML
+PLACEHOLDER_SIZE = 32
+
+# Modes Image.reduce can box-average; palette and bilevel images skip it
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK")
+
+# Records the source hash and placeholder of every processed image
+MANIFEST_NAME = ".manifest.json"
+
+# Height bound for libvips thumbnails, large enough that only the width applies
+VIPS_MAX_HEIGHT = 10_000_000
+
+if pyvips is not None:
+    # Every variant is rendered once into memory, so the operation cache
+    # would only hold on to decoded sources
+    pyvips.cache_set_max(0)
+
+def _resize_to_width(img: Image.Image, width: int, reduced: dict | None = None) -> Image.Image:
+    """Downscale an image to the given width, keeping its aspect ratio.
+
+    Images already narrower than the target are returned unchanged,
+    matching the behaviour of ``thumbnail``. Large sources in a mode
+    ``reduce`` supports are first box-averaged by an integer factor, so
+    the Lanczos filter only runs on an image at most twice the target
+    width; pass a dict as ``reduced`` to share those reductions across
+    calls.
+    """
+    src_width, src_height = img.size
+    if width >= src_width:
+        return img
+    # Rounded integer division keeps the height exact and deterministic
+    height = max(1, (width * src_height + src_width // 2) // src_width)
+
+    factor = src_width // (width * 2)
+    if factor > 1 and img.mode in REDUCE_MODES:
+        if reduced is None:
+            reduced = {}
+        if factor not in reduced:
+            reduced[factor] = img.reduce(factor)
+        img = reduced[factor]
+    return img.resize((width, height), Image.LANCZOS)
+
+
+def _resize_to_width_vips(img: "pyvips.Image", width: int) -> "pyvips.Image":
+    """Downscale a libvips image to the given width, keeping its aspect ratio.
+
+    The result is rendered into memory so each format encodes from the
+    same pixels instead of re-running the resize.
+    """
+    return img.thumbnail_image(width, height=VIPS_MAX_HEIGHT, size="down",
+                               no_rotate=True).copy_memory()
+
+
+def _save(image, output_path: pathlib.Path, quality: int) -> None:
+    """Encode one variant, bounded by the encoder slots of this process."""
+    image_format = FORMATS[output_path.suffix.lower()]
+    with _encode_slots:
+        if isinstance(image, Image.Image):
+            # Image.save keeps encoder options on the image itself, so each
+            # thread encodes its own copy of the shared resized buffer
+            image.copy().save(output_path, format=image_format, quality=quality,
+                              **PILLOW_SAVE_OPTIONS[image_format])
+        else:
+            image.write_to_file(str(output_path), Q=quality, **VIPS_SAVE_OPTIONS[image_format])
 
-    for label, width in BREAKPOINTS.items():
-        # Generate standard resolution (1x)
-        resized = img.copy()
-        resized.thumbnail((width, width * img.height / img.width))
 
-        # Save original format (JPEG)
-        output_path = output_dir / f"{stem}-{label}{ext}"
-        resized.save(output_path, quality=quality_settings["jpeg"], optimize=True)
+def _init_worker(encode_threads: int) -> None:
+    """Limit encoder threads per worker so the process pool isn't oversubscribed."""
+    global _encode_slots
+    _encode_slots = threading.BoundedSemaphore(encode_threads)
+    if pyvips is not None:
+        pyvips.concurrency_set(encode_threads)
 
-        # Save WebP format for better compression
-        webp_output_path = output_dir / f"{stem}-{label}.webp"
-        resized.save(webp_output_path, format='WEBP', quality=quality_settings["webp"], optimize=True)
 
-        # Save AVIF format for even better compression
-        avif_output_path = output_dir / f"{stem}-{label}.avif"
-        resized.save(avif_output_path, format='AVIF', quality=quality_settings["avif"], optimize=True)
+def _output_formats(ext: str, label: str) -> tuple:
+    """Extensions and quality keys of the formats written for a breakpoint."""
+    # Original format (JPEG), WebP and AVIF for progressively better compression
+    formats = ((ext, "jpeg"), (".webp", "webp"), (".avif", "avif"))
+    return tuple(fmt for fmt in formats if fmt[1] in FORMATS_PER_BREAKPOINT[label])
 
-        # Generate retina resolution (2x) for high-DPI displays
-        retina_width = width * 2
-        retina_resized = img.copy()
-        retina_resized.thumbnail((retina_width, retina_width * img.height / img.width))
 
-        # Save retina original format (JPEG)
-        retina_output_path = output_dir / f"{stem}-{label}@2x{ext}"
-        retina_resized.save(retina_output_path, quality=quality_settings["jpeg"], optimize=True)
+def variant_paths(img_path: pathlib.Path, output_dir: pathlib.Path) -> list:
+    """Return the paths of all responsive variants generated for an image."""
+    stem, ext = img_path.stem, img_path.suffix
+    return [
+        output_dir / f"{stem}-{label}{suffix}{output_ext}"
+        for label in BREAKPOINTS
+        for suffix in ("", "@2x")
+        for output_ext, _ in _output_formats(ext, label)
+    ]
 
-        # Save retina WebP format
-        retina_webp_output_path = output_dir / f"{stem}-{label}@2x.webp"
-        retina_resized.save(retina_webp_output_path, format='WEBP', quality=quality_settings["webp"], optimize=True)
 
-        # Save retina AVIF format
-        retina_avif_output_path = output_dir / f"{stem}-{label}@2x.avif"
-        retina_resized.save(retina_avif_output_path, format='AVIF', quality=quality_settings["avif"], optimize=True)
+def _blur_placeholder(image, ext: str) -> str:
+    """Encode an ultra-light blurred version of an image as a base64 data URL."""
+    image_format = FORMATS[ext.lower()]
 
-    # Create ultra-light blur placeholder that preserves original content
-    blur = img.copy()
-    # First resize to a reasonable size that maintains aspect ratio and content
-    blur.thumbnail((150, 150))  # Larger size to preserve content details
-    # Apply moderate blur to create placeholder effect while keeping content recognizable
-    blur = blur.filter(ImageFilter.GaussianBlur(2))
+    # Create ultra-light blur placeholder that preserves the original composition.
+    # Box-filtering down to a few dozen pixels is already a strong low-pass, and
+    # the browser's upscale does the rest, so no separate Gaussian blur is needed.
+    longest = max(image.width, image.height)
+    width = max(1, (PLACEHOLDER_SIZE * image.width + longest // 2) // longest)
+    height = max(1, (PLACEHOLDER_SIZE * image.height + longest // 2) // longest)
 
     # Generate base64 data URL for the blur placeholder
-    # Always use WebP format for better compression in base64
-    buffer = io.BytesIO()
-    blur.save(buffer, format=FORMATS[ext], quality=10, optimize=True)
-    buffer.seek(0)
-    base64_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    base64_url = f"data:image/{FORMATS[ext].lower()};base64,{base64_data}"
+    if isinstance(image, Image.Image):
+        blur = image.resize((width, height), Image.BOX)
+        buffer = io.BytesIO()
+        blur.save(buffer, format=image_format, quality=10, optimize=True)
+        # getbuffer() is a zero-copy view of the encoded bytes
+        data = buffer.getbuffer()
+    else:
+        # shrink box-averages the already decoded libvips source; it only
+        # accepts factors of at least 1, so tiny sources are used as they are
+        blur = image
+        if width < image.width or height < image.height:
+            blur = image.shrink(max(1.0, image.width / width), max(1.0, image.height / height))
+        options = {"optimize_coding": True} if image_format == "JPEG" else {}
+        data = blur.write_to_buffer(ext.lower(), Q=10, keep="none", **options)
+    # base64 output is pure ASCII
+    base64_data = base64.b64encode(data).decode('ascii')
+    return f"data:image/{image_format.lower()};base64,{base64_data}"
 
-    return base64_url
+
+def generate_variants(img_path: pathlib.Path, output_dir: pathlib.Path) -> str:
+    stem, ext = img_path.stem, img_path.suffix
+    filename = img_path.name
+
+    # Ensure output directory exists
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Get quality settings for this specific image, or use defaults
+    quality_settings = CUSTOM_IMAGES_QUALITY.get(filename, DEFAULT_QUALITY)
+
+    # Decode the source a single time; every variant and the placeholder are
+    # resized from these pixels. Sources only need to be decoded at the largest
+    # retina width, which lets JPEG skip most of the full resolution IDCT.
+    max_width = max(BREAKPOINTS.values()) * 2
+    if pyvips is not None:
+        # thumbnail shrinks JPEGs on load before resampling to the retina width.
+        # Like Pillow (and the original script), it ignores EXIF orientation.
+        source = pyvips.Image.thumbnail(str(img_path), max_width, height=VIPS_MAX_HEIGHT,
+                                        size="down", no_rotate=True).copy_memory()
+    else:
+        source = Image.open(img_path)
+        # draft picks the nearest DCT scale (1/2, 1/4, 1/8) above the retina
+        # width; this is a no-op for PNG sources
+        source.draft(None, (max_width, max(1, max_width * source.height // source.width)))
+        source.load()
+        reduced = {}
+
+    # Both Pillow and libvips release the GIL while encoding, so the saves run
+    # well on threads. The placeholder is encoded alongside the variants, and
+    # each save starts as soon as its resized buffer is ready.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ENCODE_THREADS) as executor:
+        placeholder = executor.submit(_blur_placeholder, source, ext)
+        futures = [placeholder]
+        for label, width in BREAKPOINTS.items():
+            # Downscale the source once to the retina (2x) size for high-DPI
+            # displays and derive the standard (1x) buffer from that smaller image
+            if pyvips is not None:
+                retina = _resize_to_width_vips(source, width * 2)
+                standard = _resize_to_width_vips(retina, width)
+            else:
+                retina = _resize_to_width(source, width * 2, reduced)
+                standard = _resize_to_width(retina, width)
+
+            for suffix, resized in (("", standard), ("@2x", retina)):
+                for output_ext, quality_key in _output_formats(ext, label):
+                    output_path = output_dir / f"{stem}-{label}{suffix}{output_ext}"
+                    futures.append(executor.submit(_save, resized, output_path,
+                                                   quality_settings[quality_key]))
+    for future in futures:
+        future.result()
+
+    return placeholder.result()
+
+
+def _process_one(img_path: pathlib.Path, output_dir: pathlib.Path) -> tuple[str, str]:
+    """Generate all variants for one image; runs inside a worker process."""
+    print(f"Processing {img_path} -> {output_dir}")
+    return img_path.stem, generate_variants(img_path, output_dir)
 
 
 def collect_images(paths):
+    extensions = (".jpg", ".jpeg", ".png")
     for p in paths:
         path = pathlib.Path(p)
         if path.is_dir():
-            yield from path.glob("*.jpg")
-            yield from path.glob("*.png")
-        elif path.suffix.lower() in {".jpg", ".jpeg", ".png"}:
+            # A single directory pass, filtering on the names readdir already returned
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(extensions) and entry.is_file():
+                        yield pathlib.Path(entry.path)
+        elif path.suffix.lower() in extensions:
             yield path
 
 
@@ -132,37 +305,80 @@ def clean_output_directory(output_dir: pathlib.Path) -> None:
     output_dir.mkdir(parents=True, exist_ok=True)
 
 
+def source_hash(img_path: pathlib.Path) -> str:
+    """Hash an image's contents together with the settings used to encode it."""
+    digest = hashlib.blake2b(img_path.read_bytes())
+    # Anything that changes the encoded output must invalidate existing variants:
+    # sizes, formats, qualities, encoder options and the backend doing the work
+    quality_settings = CUSTOM_IMAGES_QUALITY.get(img_path.name, DEFAULT_QUALITY)
+    backend = "pyvips" if pyvips is not None else "pillow"
+    settings = [BREAKPOINTS, FORMATS_PER_BREAKPOINT, quality_settings, PLACEHOLDER_SIZE,
+                PILLOW_SAVE_OPTIONS, VIPS_SAVE_OPTIONS, backend]
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir: pathlib.Path) -> dict:
+    """Load the build manifest from the output directory, if there is one."""
+    manifest_file = output_dir / MANIFEST_NAME
+    try:
+        return json.loads(manifest_file.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(output_dir: pathlib.Path, manifest: dict) -> None:
+    """Atomically write the build manifest to the output directory."""
+    manifest_file = output_dir / MANIFEST_NAME
+    tmp_file = manifest_file.with_name(manifest_file.name + ".tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp_file, manifest_file)
+
+
 def update_html_with_base64(html_file: pathlib.Path, base64_mapping: dict) -> None:
     """Update HTML file with base64 data URLs for blur placeholders."""
     if not html_file.exists():
         print(f"HTML file not found: {html_file}")
         return
 
-    content = html_file.read_text(encoding='utf-8')
-
-    for image_stem, base64_url in base64_mapping.items():
-        # Pattern to match img src attributes that reference this specific image
-        # This works for both file paths and existing base64 data URLs
-
-        # First, try to match file paths like "images/hero-bg-blur.webp"
-        file_pattern = rf'src="[^"]*{re.escape(image_stem)}-blur\.[^"]*"'
-
-        # Second, try to match within the context of the specific image's picture element
-        # Look for the pattern: srcset with the image name, followed by img tag
-        picture_context_pattern = rf'(<picture[^>]*>.*?srcset="[^"]*{re.escape(image_stem)}-[^"]*".*?<img[^>]*src=")[^"]*(".*?</picture>)'
-
-        # Try file path replacement first
-        if re.search(file_pattern, content):
-            content = re.sub(file_pattern, f'src="{base64_url}"', content)
-            print(f"Updated {image_stem} blur image file path with base64 data URL")
-        # Try picture context replacement for existing base64
-        elif re.search(picture_context_pattern, content, re.DOTALL):
-            content = re.sub(picture_context_pattern, rf'\1{base64_url}\2', content, flags=re.DOTALL)
-            print(f"Updated {image_stem} base64 data URL within picture context")
+    # Each placeholder <img> names its source image in a data-blur attribute,
+    # e.g. <img data-blur="hero-bg" src="...">, so a single pass over the
+    # document finds every placeholder regardless of how many images there are
+    img_pattern = re.compile(rb'<img\b[^>]*\bdata-blur="([^"]+)"[^>]*>')
+    src_pattern = re.compile(rb'(?<![\w-])src="[^"]*"')
+    updated = set()
+
+    with open(html_file, "r+b") as fd:
+        # Scan the document through a read-only memory map and copy the
+        # untouched slices straight from it into a single output buffer
+        content = bytearray()
+        if os.fstat(fd.fileno()).st_size:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                position = 0
+                for match in img_pattern.finditer(mm):
+                    image_stem = match.group(1).decode('utf-8')
+                    src = src_pattern.search(mm, match.start(), match.end())
+                    if image_stem not in base64_mapping or src is None:
+                        continue
+                    updated.add(image_stem)
+                    content += view[position:src.start()]
+                    content += f'src="{base64_mapping[image_stem]}"'.encode('ascii')
+                    position = src.end()
+                content += view[position:]
+
+        # The new document is fully built before anything is written back.
+        # Rewriting the same file in place (rather than replacing it) follows
+        # symlinks and keeps its mode and owner, e.g. on the Docker bind mount.
+        fd.seek(0)
+        fd.write(content)
+        fd.truncate()
+
+    for image_stem in base64_mapping:
+        if image_stem in updated:
+            print(f"Updated {image_stem} blur placeholder with base64 data URL")
         else:
             print(f"Info: {image_stem} not found in HTML (may not be used on this page)")
 
-    html_file.write_text(content, encoding='utf-8')
     print(f"Updated HTML file: {html_file}")
 
 
@@ -174,22 +390,60 @@ def main():
                        help="Output directory for processed images (default: images)")
     parser.add_argument("--html", default="index.html",
                        help="HTML file to update with base64 data URLs (default: index.html)")
+    parser.add_argument("--force", "-f", action="store_true",
+                       help="Clean the output directory and regenerate every image")
     args = parser.parse_args()
 
     output_dir = pathlib.Path(args.output)
     html_file = pathlib.Path(args.html)
 
-    # Clean output directory before processing
-    print(f"Cleaning output directory: {output_dir}")
-    clean_output_directory(output_dir)
+    # Generated variants must never be picked up again as sources
+    for p in args.paths:
+        path = pathlib.Path(p).resolve()
+        source_dir = path if path.is_dir() else path.parent
+        if source_dir == output_dir.resolve():
+            parser.error(f"{p} is inside the output directory {output_dir}; "
+                         "pass the original images instead (e.g. original_images/)")
+
+    if args.force:
+        print(f"Cleaning output directory: {output_dir}")
+        clean_output_directory(output_dir)
+    else:
+        output_dir.mkdir(parents=True, exist_ok=True)
 
     # Collect base64 data URLs for blur placeholders
     base64_mapping = {}
 
+    # Skip images whose contents and settings match the manifest when all
+    # of their variants are still on disk
+    manifest = load_manifest(output_dir)
+    hashes = {}
+    pending = []
     for img_path in collect_images(args.paths):
-        print(f"Processing {img_path} -> {output_dir}")
-        base64_url = generate_variants(img_path, output_dir)
-        base64_mapping[img_path.stem] = base64_url
+        hashes[img_path.stem] = source_hash(img_path)
+        entry = manifest.get(img_path.stem)
+        if (entry and entry["hash"] == hashes[img_path.stem]
+                and all(path.exists() for path in variant_paths(img_path, output_dir))):
+            print(f"Skipping unchanged {img_path}")
+            base64_mapping[img_path.stem] = entry["placeholder"]
+        else:
+            pending.append(img_path)
+
+    # Each source image is independent, so spread them across processes.
+    # AVIF encodes are capped to one thread each and the encoder threads of
+    # every worker share the cores to avoid oversubscription.
+    cpu_count = os.cpu_count() or 1
+    workers = max(1, min(cpu_count, len(pending)))
+    encode_threads = max(1, min(ENCODE_THREADS, cpu_count // workers))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(encode_threads,)) as executor:
+        results = executor.map(_process_one, pending, itertools.repeat(output_dir), chunksize=1)
+        for stem, base64_url in results:
+            base64_mapping[stem] = base64_url
+            manifest[stem] = {"hash": hashes[stem], "placeholder": base64_url}
+
+    if pending:
+        save_manifest(output_dir, manifest)
 
     # Update HTML file with base64 data URLs
     if base64_mapping: